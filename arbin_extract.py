@@ -6,8 +6,15 @@ import data_join
 import logging
 import pandas
 import datetime
+import queue
+import threading
 import config
-from typing import List, Tuple, Any
+import coordination
+import channel_store
+import change_detection
+import profiling
+import csv_writer
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple
 
 
 class NameTestChannel:
@@ -83,69 +90,341 @@ def new_data(cfg: Any,
     return fresh_data, list_starts, list_stops, list_dbs
 
 
-def main() -> None:
-    logging.basicConfig(
-        format='%(asctime)s %(message)s',
-        filename=os.path.join(cfg.path_to_completed_list, 'Conversion.log'),
-        level=logging.DEBUG)
-    logging.info('Connecting to database')
-    conn, c = sql_functions.db_connect(cfg, "ArbinMasterData")
-    logging.info('Connected')
+def converted_frame(converted: Dict[str, Tuple[float, int]]) \
+        -> pandas.DataFrame:
+    """
+    Build the converted tests table from name: (test_last_time,
+    record_length) pairs, as returned by the shared lease store
+    """
+    return pandas.DataFrame(
+        [[name, last_time, length]
+         for name, (last_time, length) in converted.items()],
+        columns=['converted_test_and_ch', 'test_last_time', 'record_length'])
+
 
+def converted_state(converted_tests: pandas.DataFrame) \
+        -> Dict[str, Tuple[float, int]]:
+    """
+    Inverse of converted_frame, taking the latest state where a
+    test-channel has more than one row
+    """
+    converted = {}  # type: Dict[str, Tuple[float, int]]
+    for name, group in converted_tests.groupby('converted_test_and_ch'):
+        converted[name] = (group.test_last_time.max(),
+                           group.record_length.max())
+    return converted
+
+
+def write_csv(frame: pandas.DataFrame, path: str) -> None:
+    """
+    Write through a temporary file and rename it into place so that readers
+    and other workers never see a partially written csv. Rewriting the same
+    test-channel twice just replaces the file
+    """
+    write_csv_chunks([frame], path)
+
+
+def write_csv_chunks(chunks: Iterable[pandas.DataFrame], path: str,
+                     executor: Any = None, compression: Optional[str] = None,
+                     block_rows: int = 50000, workers: int = 1) -> None:
+    """
+    Same as write_csv for a frame that arrives in chunks, the result is the
+    same file as writing the concatenated frame. Blocks of rows are
+    formatted on the executor if one is given, and compressed if
+    compression is 'gzip' or 'zstd'
+    """
+    temp_path = coordination.unique_temp_path(path)
+    try:
+        with csv_writer.ParallelCsvWriter(temp_path, executor, compression,
+                                          block_rows=block_rows,
+                                          workers=workers) as writer:
+            for chunk in chunks:
+                writer.write(chunk)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+    os.replace(temp_path, path)
+
+
+def tee_channel_store(path: str, chunks: Iterable[pandas.DataFrame],
+                      test_id: int, new_test: bool = False) \
+        -> Iterator[pandas.DataFrame]:
+    """
+    Pass the chunks of a joined test through, appending the data points
+    past the end of the binary store to it on the way. The store is
+    rebuilt from the start if it holds another test, or a new test is
+    being converted
+    """
+    store = channel_store.ChannelStore(path)
+    stored_rows = store.n_rows
+    checked = False
+    length = 0
+    for chunk in chunks:
+        if not checked and not chunk.empty:
+            checked = True
+            first_date_time = chunk['DateTime'].iloc[0]
+            if new_test or not store.is_test(test_id, first_date_time):
+                if stored_rows:
+                    logging.info('Rebuilding channel store: ' + path)
+                store.reset(test_id, first_date_time)
+                stored_rows = 0
+        store.append(chunk[chunk.index >= stored_rows])
+        length += len(chunk.index)
+        yield chunk
+    if length < stored_rows:
+        logging.warning('Test is shorter than its channel store: ' + path)
+        store.truncate(length)
+
+
+class JoinedChannel:
+    """
+    One test-channel with new data, as produced by iter_joined_channels.
+    chunks is the joined test as a data_join.JoinedFrames, pulled from the
+    result databases as it is iterated; frame joins all of it at once.
+    query_test_length is only known once the chunks have been consumed.
+    previous_length is the record length from the last conversion, 0 for
+    a new test, which has new_test set
+    """
+    def __init__(self, test_name_channel: NameTestChannel, name: str,
+                 previous_length: int, meta_data_frame: pandas.DataFrame,
+                 chunks: data_join.JoinedFrames,
+                 new_test: bool = False) -> None:
+        self.test_name_channel = test_name_channel
+        self.name = name
+        self.previous_length = previous_length
+        self.new_test = new_test
+        self.meta_data_frame = meta_data_frame
+        self.chunks = chunks
+        self._frame = None  # type: Optional[pandas.DataFrame]
+
+    @property
+    def frame(self) -> pandas.DataFrame:
+        if self._frame is None:
+            self._frame = pandas.concat(list(self.chunks))
+        return self._frame
+
+    @property
+    def query_final_time(self) -> float:
+        return self.chunks.query_last_time
+
+    @property
+    def query_test_length(self) -> int:
+        return self.chunks.length
+
+
+def iter_joined_channels(
+        cfg: Any,
+        c: Any,
+        converted: Optional[Dict[str, Tuple[float, int]]] = None,
+        lease_store: Any = None,
+        fingerprints: Any = None,
+        profiler: Any = profiling.NULL_PROFILER) -> Iterator[JoinedChannel]:
+    """
+    Discover the test-channels in the database and lazily join the ones
+    with new data, one channel at a time. converted maps the names of
+    already converted test-channels to (test_last_time, record_length),
+    channels not in it are joined from the start of the test.
+    Channels held by another worker or found to have no new data are
+    skipped. The caller owns the bookkeeping for the channels it receives:
+    recording them as converted, releasing their lease and marking their
+    fingerprint once the data has been consumed.
+    """
+    if converted is None:
+        converted = {}
     test_name_chs = list_test_channels(cfg, c)
     logging.info(
         'Number of test name-channels in database:' + str(len(test_name_chs)))
 
-    try:
-        converted_tests = pandas.read_pickle(cfg.path_to_completed_list)
-    except FileNotFoundError:
-        converted_tests = pandas.DataFrame(columns=[
-            'converted_test_and_ch', 'test_last_time', 'record_length'
-        ])
-    logging.info('Number of test name-channels converted:' +
-                 str(len(converted_tests.index)))
-
     for test_name_channel in test_name_chs:
         name = test_name_channel.test + cfg.channel_delimiter + str(
             test_name_channel.channel + 1)  # +1 The Liveware Problem
-        if name in converted_tests.converted_test_and_ch.unique():
-            test_final_time = converted_tests.test_last_time[converted_tests[
-                'converted_test_and_ch'] == name].max()
-            test_length = converted_tests.record_length[converted_tests[
-                'converted_test_and_ch'] == name].max()
+        if fingerprints is not None and fingerprints.unchanged(
+                name, test_name_channel.test_id, test_name_channel.channel):
+            logging.debug('Unchanged: ' + name)
+            continue
+        previous = converted.get(name)
+        if lease_store is not None:
+            if not lease_store.claim(name):
+                logging.info('Claimed by another worker: ' + name)
+                continue
+            # another worker may have converted it since the sweep started
+            previous = lease_store.converted_state(name)
+        if previous is not None:
+            test_final_time, test_length = previous
             fresh_data, starts, stops, dbs = new_data(
                 cfg, test_name_channel.test_id, test_name_channel.channel, c,
                 test_final_time)
 
             min_db_num = min(list(int(db[12:]) for db in dbs[0].split(',')[:-1]))  #This is to get around a corrupted db
-            if fresh_data and min_db_num >= cfg.MIN_DATABASE_NUMBER:
-                logging.info('Updating: ' + name + ' with test_id:' + str(test_name_channel.test_id))
-
-                full_test_frame, query_final_time, query_test_length = \
-                    data_join.pull_and_join(cfg, test_name_channel.test_id,
-                                            test_name_channel.channel,
-                                            starts, stops, dbs)
-
-                meta_data_frame = data_join.pull_meta_data(
-                    cfg, test_name_channel.test_id, test_name_channel.channel)
-            else:
+            if not (fresh_data and min_db_num >= cfg.MIN_DATABASE_NUMBER):
                 logging.info('No new data: ' + name)
+                if fingerprints is not None:
+                    fingerprints.mark(name)
+                if lease_store is not None:
+                    lease_store.release(name)
                 continue
+            logging.info('Updating: ' + name + ' with test_id:' + str(test_name_channel.test_id))
         else:
             logging.info('New test: ' + name + ' with test_id:' + str(test_name_channel.test_id))
             test_length = 0
             fresh_data, starts, stops, dbs = new_data(
                 cfg, test_name_channel.test_id, test_name_channel.channel, c)
-            print(fresh_data, starts, stops, dbs)
+            logging.debug('Windows: ' + str((fresh_data, starts, stops, dbs)))
 
-            full_test_frame, query_final_time, query_test_length = \
-                data_join.pull_and_join(cfg, test_name_channel.test_id,
-                                        test_name_channel.channel,
-                                        starts, stops, dbs)
+        # only the channels that are joined are profiled
+        with profiler.channel(name):
+            joined_frames = data_join.JoinedFrames(
+                cfg, test_name_channel.test_id, test_name_channel.channel,
+                starts, stops, dbs, profiler)
             meta_data_frame = data_join.pull_meta_data(
                 cfg, test_name_channel.test_id, test_name_channel.channel)
-            print(query_final_time, query_test_length)
+            yield JoinedChannel(test_name_channel, name, test_length,
+                                meta_data_frame, joined_frames,
+                                new_test=previous is None)
+
+
+def prefetch(iterable: Iterable, depth: int) -> Iterator:
+    """
+    Run an iterator in a background thread, at most depth items ahead of
+    the consumer, so that pulling the next channel or chunk from the
+    databases overlaps with writing the current one. Exceptions are
+    re-raised in the consumer. If the consumer stops early, by break,
+    close() or an exception, the background thread finishes the item it
+    is on, closes the source iterator and exits
+    """
+    if depth <= 0:
+        yield from iterable
+        return
+    items = queue.Queue(maxsize=depth)  # type: queue.Queue
+    stop = threading.Event()
+    done = object()
+
+    def put(item: Tuple) -> bool:
+        while not stop.is_set():
+            try:
+                items.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def produce() -> None:
+        source = iter(iterable)
+        try:
+            for item in source:
+                if not put((item, None)):
+                    return
+            put((done, None))
+        except Exception as error:
+            put((done, error))
+        finally:
+            close = getattr(source, 'close', None)
+            if close is not None:
+                close()
+
+    producer = threading.Thread(target=produce, daemon=True)
+    producer.start()
+    try:
+        while True:
+            item, error = items.get()
+            if error is not None:
+                raise error
+            if item is done:
+                break
+            yield item
+    finally:
+        stop.set()
+        producer.join()
+
+
+def write_joined_channel(cfg: Any, joined: JoinedChannel, depth: int = 0,
+                         executor: Any = None,
+                         lease_store: Any = None) -> None:
+    """
+    The csv files, and the binary channel store if configured, are the
+    consumer of iter_joined_channels used by the extraction script. The
+    test is written chunk by chunk as it is pulled, with the next chunk
+    prefetched up to depth chunks ahead. With csv_compression set in the
+    configuration the data file gets a .gz or .zst extension and the copy
+    written with any other setting is removed; the metadata file is always
+    plain csv
+    """
+    chunks = coordination.renewing(lease_store, joined.name,
+                                   prefetch(joined.chunks, depth))
+    if getattr(cfg, 'channel_store_folder', None):
+        chunks = tee_channel_store(
+            os.path.join(cfg.channel_store_folder, joined.name), chunks,
+            joined.test_name_channel.test_id, joined.new_test)
+    compression = getattr(cfg, 'csv_compression', None)
+    data_path = os.path.join(cfg.data_folder, joined.name + '.csv')
+    write_csv_chunks(chunks, data_path + csv_writer.EXTENSIONS[compression],
+                     executor, compression,
+                     getattr(cfg, 'csv_block_rows', 50000),
+                     csv_writer.csv_workers(cfg))
+    # a file left from a sweep with other compression settings is stale
+    for other, extension in csv_writer.EXTENSIONS.items():
+        if other != compression and os.path.exists(data_path + extension):
+            os.remove(data_path + extension)
+    write_csv(joined.meta_data_frame,
+              os.path.join(cfg.data_folder,
+                           joined.name + '_Metadata' + '.csv'))
+
 
+def main() -> None:
+    logging.basicConfig(
+        format='%(asctime)s %(message)s',
+        filename=os.path.join(cfg.path_to_completed_list, 'Conversion.log'),
+        level=logging.DEBUG)
+    # before any thread or database connection exists
+    executor = csv_writer.open_executor(cfg)
+    logging.info('Connecting to database')
+    conn, c = sql_functions.db_connect(cfg, "ArbinMasterData")
+    logging.info('Connected')
+
+    lease_store = coordination.open_lease_store(cfg)
+    try:
+        converted_tests = pandas.read_pickle(cfg.path_to_completed_list)
+    except FileNotFoundError:
+        converted_tests = converted_frame({})
+    if lease_store is not None:
+        logging.info('Claiming test name-channels as: ' + lease_store.owner)
+        # the first sharded sweep starts from the single host completed list
+        imported = lease_store.import_converted(
+            converted_state(converted_tests))
+        if imported:
+            logging.info('Imported converted test name-channels:' +
+                         str(imported))
+        converted_tests = converted_frame(lease_store.converted())
+    logging.info('Number of test name-channels converted:' +
+                 str(len(converted_tests.index)))
+    converted = converted_state(converted_tests)
+    fingerprints = change_detection.open_fingerprints(
+        cfg, c, sharded=lease_store is not None)
+    profiler = profiling.open_profiler(cfg)
+
+    joined_channels = iter_joined_channels(cfg, c, converted, lease_store,
+                                           fingerprints, profiler)
+    depth = 0
+    if profiler is profiling.NULL_PROFILER:
+        # profiles are per channel, so only prefetch when not profiling
+        depth = getattr(cfg, 'prefetch', 0)
+    joined_channels = prefetch(joined_channels, depth)
+
+    for joined in joined_channels:
+        name = joined.name
+        # the result databases are queried as the chunks are written, so
+        # the profiler stages of the join are recorded in here
+        try:
+            write_joined_channel(cfg, joined, depth, executor, lease_store)
+        except coordination.LeaseLost:
+            # another worker has taken the channel over and redoes it
+            logging.warning('Lease lost while converting: ' + name)
+            continue
+        query_final_time = joined.query_final_time
+        query_test_length = joined.query_test_length
+
+        if name not in converted_tests.converted_test_and_ch.unique():
             new_converted_row = pandas.DataFrame(
                 [[name, query_final_time, query_test_length]],
                 columns=[
@@ -153,25 +432,34 @@ def main() -> None:
                 ])
             converted_tests = converted_tests.append(
                 new_converted_row, ignore_index=True)
-
-        full_test_frame.to_csv(
-            path_or_buf=os.path.join(cfg.data_folder, name + '.csv'))
-        meta_data_frame.to_csv(
-            path_or_buf=os.path.join(cfg.data_folder,
-                                     name + '_Metadata' + '.csv'))
-
         converted_tests.loc[converted_tests['converted_test_and_ch'] == name,
                             'test_last_time'] = query_final_time
         converted_tests.loc[converted_tests['converted_test_and_ch'] == name,
                             'record_length'] = query_test_length
-        converted_tests.to_pickle(cfg.path_to_completed_list)
+        if lease_store is None:
+            converted_tests.to_pickle(cfg.path_to_completed_list)
+        else:
+            if not lease_store.record_converted(name, query_final_time,
+                                                query_test_length):
+                logging.warning('Lease lost while converting: ' + name)
+            lease_store.release(name)
+        if fingerprints is not None:
+            fingerprints.mark(name)
+            fingerprints.save()
         readable_datetime = datetime.datetime.fromtimestamp(
             float(query_final_time)).strftime('%Y-%m-%d %H:%M:%S')
         logging.info('Test: ' + name + ' Last data time:' + readable_datetime)
         logging.info('Finished with test: ' + name + ' Old length:' + str(
-            test_length) + ' New length:' + str(query_test_length))
+            joined.previous_length) + ' New length:' + str(query_test_length))
 
     conn.close()
+    if executor is not None:
+        executor.shutdown()
+    if fingerprints is not None:
+        fingerprints.save()
+    profiler.summarize()
+    if lease_store is not None:
+        lease_store.close()
 
 
 if __name__ == "__main__":
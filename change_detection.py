@@ -0,0 +1,147 @@
+# Copyright 2018 Toyota Research Institute. All rights reserved.
+import os
+import pickle
+import socket
+import threading
+import time
+import logging
+import pypyodbc
+import sql_functions
+import data_join
+import coordination
+from typing import Any, Dict, Optional, Tuple
+
+
+class ChannelFingerprints:
+    """
+    Cheap check for whether a test-channel can have new data since it was
+    last converted. The fingerprint of a channel is its TestIVChList_Table
+    rows (Last_End_DateTime and Databases) plus the latest raw data and
+    event time stamps for the channel in its last result database.
+    The master table is read once per sweep. A channel whose last data was
+    older than stable_seconds when its fingerprint was saved is treated as
+    finished: while its master rows stay the same it is skipped without
+    touching the result databases, except every recheck_sweeps sweeps
+    since Last_End_DateTime does not always change when a test resumes.
+    Other channels cost one indexed query each, so a sweep with no new data
+    scales with the number of active channels.
+    Saved fingerprints are (rows, marks, saved_at, sweeps skipped).
+    """
+
+    def __init__(self, cfg: Any, c: Any, path: str,
+                 stable_seconds: float = 7 * 24 * 3600,
+                 recheck_sweeps: int = 10) -> None:
+        self.cfg = cfg
+        self.path = path
+        self.stable_seconds = stable_seconds
+        self.recheck_sweeps = recheck_sweeps
+        try:
+            with open(path, 'rb') as f:
+                self.saved = pickle.load(f)  # type: Dict[str, Tuple]
+        except FileNotFoundError:
+            self.saved = {}
+        self.master = sql_functions.find_channel_fingerprints(c)
+        self.pending = {}  # type: Dict[str, Tuple]
+        self._lock = threading.Lock()
+
+    def _watermark(self, db: str, channel: int) -> Optional[Tuple]:
+        for i in range(self.cfg.ATTEMPTS):
+            try:
+                connection, cursor = sql_functions.db_connect(self.cfg, db)
+                watermark = sql_functions.find_channel_watermark(
+                    cursor, channel)
+            except pypyodbc.OperationalError:
+                logging.warning('Database read error')
+                continue
+            else:
+                connection.close()
+            return watermark
+        return None
+
+    def _stable(self, saved: Tuple) -> bool:
+        """
+        A channel is stable if nothing was logged for it in the last
+        stable_seconds before its fingerprint was saved
+        """
+        if len(saved) != 4:
+            return False
+        rows, marks, saved_at, skipped = saved
+        times = [timestamp for mark in marks for timestamp in mark
+                 if timestamp is not None]
+        if not times:
+            return False
+        last_time = data_join.ArbinTime().to_epoch(max(times))
+        return last_time < saved_at - self.stable_seconds
+
+    def unchanged(self, name: str, test_id: int, channel: int) -> bool:
+        """
+        Returns False when the fingerprint could not be read, in which case
+        the channel always has to be checked
+        """
+        master_rows = self.master.get((test_id, channel))
+        if not master_rows:
+            return False
+        rows = tuple(master_rows)
+        with self._lock:
+            saved = self.saved.get(name)
+        if saved is not None and saved[0] == rows and self._stable(saved) \
+                and saved[3] + 1 < self.recheck_sweeps:
+            with self._lock:
+                self.saved[name] = saved[:3] + (saved[3] + 1,)
+            return True
+        read_at = time.time()
+        marks = []
+        for last_end, databases in rows:
+            dbs = databases.split(',')[:-1]
+            if not dbs:
+                continue
+            watermark = self._watermark(dbs[-1], channel)
+            if watermark is None:
+                return False
+            marks.append(watermark)
+        fingerprint = (rows, tuple(marks), read_at, 0)
+        with self._lock:
+            if saved is not None and saved[:2] == fingerprint[:2]:
+                # still up to date, as of now
+                self.saved[name] = fingerprint
+                return True
+            self.pending[name] = fingerprint
+        return False
+
+    def mark(self, name: str) -> None:
+        """
+        Record that the channel is up to date as of the fingerprint read
+        earlier in this sweep
+        """
+        with self._lock:
+            if name in self.pending:
+                self.saved[name] = self.pending.pop(name)
+
+    def save(self) -> None:
+        temp_path = coordination.unique_temp_path(self.path)
+        with self._lock:
+            saved = dict(self.saved)
+        with open(temp_path, 'wb') as f:
+            pickle.dump(saved, f)
+        os.replace(temp_path, self.path)
+
+
+def open_fingerprints(cfg: Any, c: Any, sharded: bool = False) \
+        -> Optional[ChannelFingerprints]:
+    """
+    Change detection is on unless the configuration sets change_detection
+    to False. stable_seconds sets how long a channel has to be quiet before
+    it is only checked again when its master rows change, or once every
+    stable_recheck_sweeps sweeps. With sharded
+    sweeps every host keeps its own fingerprints, a stale fingerprint only
+    costs a call to new_data
+    """
+    if not getattr(cfg, 'change_detection', True):
+        return None
+    path = getattr(cfg, 'path_to_fingerprints',
+                   cfg.path_to_completed_list + '_fingerprints')
+    if sharded:
+        path = path + '_' + socket.gethostname()
+    return ChannelFingerprints(cfg, c, path,
+                               getattr(cfg, 'stable_seconds', 7 * 24 * 3600),
+                               getattr(cfg, 'stable_recheck_sweeps', 10))
@@ -0,0 +1,214 @@
+# Copyright 2018 Toyota Research Institute. All rights reserved.
+import json
+import os
+import struct
+import numpy as np
+import pandas
+from typing import List, Optional, Tuple
+
+MAGIC = b'BEEPCHS\x00'
+VERSION = 1
+HEADER_ALIGNMENT = 64
+
+# Data_Point is not stored, it is the record number in the file
+COLUMNS = [
+    ('Test_Time', '<f8'), ('DateTime', '<f8'), ('Step_Time', '<f8'),
+    ('Step_Index', '<i8'), ('Cycle_Index', '<i8'), ('Current', '<f8'),
+    ('Voltage', '<f8'), ('Charge_Capacity', '<f8'),
+    ('Discharge_Capacity', '<f8'), ('Charge_Energy', '<f8'),
+    ('Discharge_Energy', '<f8'), ('dV/dt', '<f8'),
+    ('Internal_Resistance', '<f8'), ('Temperature', '<f8'),
+    ('Aux_Voltage', '<f8')
+]
+
+INDEX_DTYPE = np.dtype([('Cycle_Index', '<i8'), ('Data_Point', '<i8')])
+
+
+class ChannelStore:
+    """
+    Append-only binary store for the joined data of one test-channel.
+    Records are fixed width so new data points are written to the end of
+    the file without rewriting it, and readers memory map the file to get
+    any range of data points without parsing. The store is two files:
+        <path>.bin  header followed by one record per data point
+        <path>.idx  (Cycle_Index, first Data_Point) for every new cycle
+    Cycle_Index is expected to be non-decreasing, as it is for Arbin tests.
+    The header records the test the data points belong to, as its test_id
+    and the DateTime of its first data point, so that a store left from an
+    earlier test of the same name is not appended to.
+    """
+
+    def __init__(self, path: str,
+                 columns: Optional[List[Tuple[str, str]]] = None) -> None:
+        self.data_path = path + '.bin'
+        self.index_path = path + '.idx'
+        self.test = None  # type: Optional[Tuple[int, float]]
+        if os.path.exists(self.data_path):
+            self.dtype, self.header_size = self._read_header()
+        else:
+            self.dtype = np.dtype(columns or COLUMNS)
+            self.header_size = self._write_header()
+
+    def _read_header(self) -> Tuple[np.dtype, int]:
+        with open(self.data_path, 'rb') as f:
+            magic, version, header_size = struct.unpack(
+                '<8sII', f.read(16))
+            if magic != MAGIC or version != VERSION:
+                raise ValueError('Not a channel store: ' + self.data_path)
+            header = json.loads(f.read(header_size - 16).decode('utf-8'))
+        if header.get('test') is not None:
+            self.test = (header['test'][0], header['test'][1])
+        return np.dtype([tuple(col) for col in header['columns']]), \
+            header_size
+
+    def _write_header(self) -> int:
+        header = json.dumps({
+            'columns': [[name, self.dtype[name].str]
+                        for name in self.columns],
+            'test': self.test
+        }).encode('utf-8')
+        header_size = -(-(16 + len(header)) // HEADER_ALIGNMENT) \
+            * HEADER_ALIGNMENT
+        with open(self.data_path, 'wb') as f:
+            f.write(struct.pack('<8sII', MAGIC, VERSION, header_size))
+            f.write(header.ljust(header_size - 16))
+        open(self.index_path, 'wb').close()
+        return header_size
+
+    @property
+    def columns(self) -> List[str]:
+        return list(self.dtype.names or ())
+
+    @property
+    def n_rows(self) -> int:
+        """
+        Number of complete records. A torn record at the end of the file
+        from an interrupted append is ignored and overwritten by the next one
+        """
+        data_size = os.path.getsize(self.data_path) - self.header_size
+        return data_size // self.dtype.itemsize
+
+    def cycle_index(self) -> np.ndarray:
+        """
+        Returns (Cycle_Index, Data_Point) of the first data point of each
+        cycle in the store
+        """
+        size = os.path.getsize(self.index_path) // INDEX_DTYPE.itemsize
+        if size == 0:
+            return np.empty(0, dtype=INDEX_DTYPE)
+        index = np.fromfile(self.index_path, dtype=INDEX_DTYPE, count=size)
+        return index[index['Data_Point'] < self.n_rows]
+
+    def append(self, frame: pandas.DataFrame) -> None:
+        """
+        Append the rows of a joined frame after the last stored data point
+        """
+        if frame.empty:
+            return
+        records = np.empty(len(frame.index), dtype=self.dtype)
+        for name in self.columns:
+            records[name] = frame[name].values
+        first_row = self.n_rows
+        index = self.cycle_index()
+
+        cycles = records['Cycle_Index']
+        new_cycle = np.empty(len(cycles), dtype=bool)
+        new_cycle[0] = len(index) == 0 or \
+            cycles[0] != index['Cycle_Index'][-1]
+        new_cycle[1:] = cycles[1:] != cycles[:-1]
+        new_index = np.empty(int(new_cycle.sum()), dtype=INDEX_DTYPE)
+        new_index['Cycle_Index'] = cycles[new_cycle]
+        new_index['Data_Point'] = np.flatnonzero(new_cycle) + first_row
+
+        # index first: entries past the last complete record are ignored,
+        # so an append interrupted at any point leaves a consistent store
+        with open(self.index_path, 'r+b') as f:
+            f.seek(len(index) * INDEX_DTYPE.itemsize)
+            f.write(new_index.tobytes())
+            f.truncate()
+        with open(self.data_path, 'r+b') as f:
+            f.seek(self.header_size + first_row * self.dtype.itemsize)
+            f.write(records.tobytes())
+            f.truncate()
+
+    def is_test(self, test_id: int, first_date_time: float) -> bool:
+        """
+        Whether the stored data points are from the test with test_id that
+        started at first_date_time
+        """
+        return self.test == (int(test_id), float(first_date_time))
+
+    def reset(self, test_id: Optional[int] = None,
+              first_date_time: Optional[float] = None) -> None:
+        """
+        Drop every stored data point, for when a test has to be re-joined
+        from the beginning, and record the test the store is now for
+        """
+        if test_id is None or first_date_time is None:
+            self.test = None
+        else:
+            self.test = (int(test_id), float(first_date_time))
+        self.header_size = self._write_header()
+
+    def truncate(self, n_rows: int) -> None:
+        """
+        Drop the data points from n_rows on
+        """
+        if n_rows == 0:
+            self.header_size = self._write_header()
+            return
+        index = self.cycle_index()
+        with open(self.data_path, 'r+b') as f:
+            f.truncate(self.header_size + n_rows * self.dtype.itemsize)
+        with open(self.index_path, 'r+b') as f:
+            f.truncate(int((index['Data_Point'] < n_rows).sum()) *
+                       INDEX_DTYPE.itemsize)
+
+    def _row_range(self, first_cycle: Optional[int],
+                   last_cycle: Optional[int]) -> Tuple[int, int]:
+        n_rows = self.n_rows
+        if first_cycle is None and last_cycle is None:
+            return 0, n_rows
+        index = self.cycle_index()
+        rows = np.append(index['Data_Point'], n_rows)
+        start, stop = 0, n_rows
+        if first_cycle is not None:
+            start = rows[np.searchsorted(
+                index['Cycle_Index'], first_cycle, side='left')]
+        if last_cycle is not None:
+            stop = rows[np.searchsorted(
+                index['Cycle_Index'], last_cycle, side='right')]
+        return int(start), int(max(start, stop))
+
+    def read(self, first_cycle: Optional[int] = None,
+             last_cycle: Optional[int] = None) -> np.ndarray:
+        """
+        Returns a read-only memory mapped view of the records for the cycles
+        first_cycle to last_cycle inclusive, every record by default
+        """
+        start, stop = self._row_range(first_cycle, last_cycle)
+        if stop == start:
+            return np.empty(0, dtype=self.dtype)
+        return np.memmap(self.data_path, dtype=self.dtype, mode='r',
+                         offset=self.header_size + start * self.dtype.itemsize,
+                         shape=(stop - start,))
+
+    def to_frame(self, first_cycle: Optional[int] = None,
+                 last_cycle: Optional[int] = None) -> pandas.DataFrame:
+        """
+        Same as read but as a data frame indexed by Data_Point, laid out
+        like the frames returned by data_join.pull_and_join
+        """
+        start, stop = self._row_range(first_cycle, last_cycle)
+        records = self.read(first_cycle, last_cycle)
+        frame = pandas.DataFrame(
+            {name: records[name] for name in self.columns},
+            columns=self.columns,
+            index=pandas.RangeIndex(start, stop, name='Data_Point'))
+        return frame
+
+    def to_csv(self, path: str) -> None:
+        """
+        Converter for consumers that still read the csv files
+        """
+        self.to_frame().to_csv(path_or_buf=path)
@@ -0,0 +1,216 @@
+# Copyright 2018 Toyota Research Institute. All rights reserved.
+import os
+import socket
+import contextlib
+import sqlite3
+import threading
+import time
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple
+
+
+class LeaseLost(Exception):
+    """
+    Raised when a worker finds its lease on a test-channel was taken over
+    by another worker while it was still converting it
+    """
+
+
+class LeaseStore:
+    """
+    Shared store that lets several extraction hosts split the list of
+    test-channels between them. A worker has to hold an unexpired lease on a
+    test-channel before converting it, and the converted state that used to
+    live only in the pickled completed list is recorded here as well, so
+    workers never race on that file. Leases expire, so if a worker dies
+    its channels are picked up by another worker on a later sweep.
+    The store is a single SQLite file. SQLite locking is not reliable over
+    NFS or SMB, so keeping the store on a shared filesystem is only meant
+    for testing sharded sweeps across hosts.
+    """
+
+    def __init__(self, path: str, owner: Optional[str] = None,
+                 lease_seconds: float = 3600) -> None:
+        self.path = path
+        self.owner = owner or '{}:{}'.format(socket.gethostname(), os.getpid())
+        self.lease_seconds = lease_seconds
+        self._lock = threading.Lock()
+        self.connection = sqlite3.connect(
+            path, timeout=60, isolation_level=None, check_same_thread=False)
+        self.connection.executescript("""
+            CREATE TABLE IF NOT EXISTS leases (
+                name TEXT PRIMARY KEY,
+                owner TEXT NOT NULL,
+                expires REAL NOT NULL);
+            CREATE TABLE IF NOT EXISTS converted (
+                name TEXT PRIMARY KEY,
+                test_last_time REAL NOT NULL,
+                record_length INTEGER NOT NULL,
+                owner TEXT NOT NULL,
+                updated REAL NOT NULL);""")
+
+    @contextlib.contextmanager
+    def _transaction(self) -> Iterator[sqlite3.Cursor]:
+        """
+        Immediate transaction so that the checks and the updates made in it
+        are atomic across processes and hosts
+        """
+        with self._lock:
+            cursor = self.connection.cursor()
+            cursor.execute('BEGIN IMMEDIATE')
+            try:
+                yield cursor
+            except BaseException:
+                cursor.execute('ROLLBACK')
+                raise
+            cursor.execute('COMMIT')
+
+    def _write(self, statements: List[Tuple[str, Tuple]]) -> int:
+        """
+        Run the statements in one transaction, returns the number of rows
+        they changed
+        """
+        count = 0
+        with self._transaction() as cursor:
+            for sql_cmd, params in statements:
+                cursor.execute(sql_cmd, params)
+                count += cursor.rowcount
+        return count
+
+    def claim(self, name: str) -> bool:
+        """
+        Try to take the lease on a test-channel. Succeeds if nobody holds
+        it, the current lease has expired, or this worker already owns it
+        """
+        now = time.time()
+        # INSERT OR IGNORE then UPDATE rather than an upsert, which needs
+        # SQLite 3.24 and is missing from some Python 3.6 builds
+        count = self._write([
+            ('INSERT OR IGNORE INTO leases (name, owner, expires) '
+             'VALUES (?, ?, ?);',
+             (name, self.owner, now + self.lease_seconds)),
+            ("""UPDATE leases SET owner = ?, expires = ?
+                WHERE name = ? AND (expires < ? OR owner = ?);""",
+             (self.owner, now + self.lease_seconds, name, now, self.owner))])
+        return count > 0
+
+    def renew(self, name: str) -> bool:
+        """
+        Extend a lease this worker still holds. Returns False if the lease
+        expired and was taken over by another worker in the meantime
+        """
+        now = time.time()
+        count = self._write([
+            ("""UPDATE leases SET expires = ?
+                WHERE name = ? AND owner = ? AND expires >= ?;""",
+             (now + self.lease_seconds, name, self.owner, now))])
+        return count == 1
+
+    def release(self, name: str) -> None:
+        self._write([('DELETE FROM leases WHERE name = ? AND owner = ?;',
+                      (name, self.owner))])
+
+    def record_converted(self, name: str, test_last_time: float,
+                         record_length: int) -> bool:
+        """
+        Store the converted state for a test-channel, but only while this
+        worker still holds the lease. Redoing a channel after a lost lease
+        is harmless, the row is just overwritten
+        """
+        now = time.time()
+        held = ('EXISTS (SELECT 1 FROM leases '
+                'WHERE name = ? AND owner = ? AND expires >= ?)')
+        lease = (name, self.owner, now)
+        count = self._write([
+            ("""INSERT OR IGNORE INTO converted
+                    (name, test_last_time, record_length, owner, updated)
+                SELECT ?, ?, ?, ?, ? WHERE """ + held + ';',
+             (name, float(test_last_time), int(record_length), self.owner,
+              now) + lease),
+            ("""UPDATE converted SET test_last_time = ?, record_length = ?,
+                    owner = ?, updated = ?
+                WHERE name = ? AND """ + held + ';',
+             (float(test_last_time), int(record_length), self.owner, now,
+              name) + lease)])
+        return count > 0
+
+    def converted(self) -> Dict[str, Tuple[float, int]]:
+        """
+        Return the converted state of every test-channel as
+        name: (test_last_time, record_length)
+        """
+        with self._lock:
+            rows = self.connection.execute(
+                'SELECT name, test_last_time, record_length FROM converted;'
+            ).fetchall()
+        return {name: (last_time, length) for name, last_time, length in rows}
+
+    def converted_state(self, name: str) -> Optional[Tuple[float, int]]:
+        """
+        Return (test_last_time, record_length) for one test-channel, or None
+        if it has not been converted yet
+        """
+        with self._lock:
+            row = self.connection.execute(
+                'SELECT test_last_time, record_length FROM converted '
+                'WHERE name = ?;', (name,)).fetchone()
+        return None if row is None else (row[0], row[1])
+
+    def import_converted(self, converted: Dict[str, Tuple[float, int]]) \
+            -> int:
+        """
+        Seed an empty store with the converted state of a single host
+        sweep, name: (test_last_time, record_length), so that switching to
+        sharded sweeps does not re-join every test. Does nothing once the
+        store has any converted test-channel. Returns the number imported
+        """
+        now = time.time()
+        count = 0
+        with self._transaction() as cursor:
+            if cursor.execute('SELECT 1 FROM converted LIMIT 1;').fetchone():
+                return 0
+            for name, (last_time, length) in converted.items():
+                cursor.execute(
+                    """INSERT INTO converted
+                           (name, test_last_time, record_length, owner,
+                            updated)
+                       VALUES (?, ?, ?, ?, ?);""",
+                    (name, float(last_time), int(length), self.owner, now))
+                count += 1
+        return count
+
+    def close(self) -> None:
+        self.connection.close()
+
+
+def renewing(lease_store: Optional[LeaseStore], name: str,
+             items: Iterable) -> Iterator:
+    """
+    Pass items through, renewing the lease on name before each one so a
+    long conversion keeps its lease. Raises LeaseLost as soon as the lease
+    cannot be renewed, before the item is handed on to be written
+    """
+    for item in items:
+        if lease_store is not None and not lease_store.renew(name):
+            raise LeaseLost('Lease lost on: ' + name)
+        yield item
+
+
+def unique_temp_path(path: str) -> str:
+    """
+    Temporary file next to path that no other process, on this host or
+    another one sharing the folder, will use at the same time
+    """
+    return '{}.{}.{}.tmp'.format(path, socket.gethostname(), os.getpid())
+
+
+def open_lease_store(cfg: Any) -> Optional[LeaseStore]:
+    """
+    Sharded sweeps are opt-in: if the configuration has no lease_store
+    path a single host converts every test-channel as before. The first
+    sharded sweep imports the completed list into an empty store
+    """
+    path = getattr(cfg, 'lease_store', None)
+    if not path:
+        return None
+    return LeaseStore(path, getattr(cfg, 'worker_name', None),
+                      getattr(cfg, 'lease_seconds', 3600))
@@ -0,0 +1,131 @@
+# Copyright 2018 Toyota Research Institute. All rights reserved.
+import os
+import gzip
+import collections
+import concurrent.futures
+import multiprocessing
+import pandas
+from typing import Any, Optional
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+EXTENSIONS = {None: '', 'gzip': '.gz', 'zstd': '.zst'}
+DEFAULT_LEVELS = {'gzip': 6, 'zstd': 3}
+
+
+def format_block(frame: pandas.DataFrame, header: bool,
+                 compression: Optional[str], level: int) -> bytes:
+    """
+    Format a block of rows exactly as to_csv would write them to a file,
+    and compress them on their own. Concatenated gzip members and zstd
+    frames are still one valid stream, so blocks can be compressed in
+    parallel and written one after the other
+    """
+    text = frame.to_csv(header=header)
+    if os.linesep != '\n' and not text.endswith(os.linesep):
+        # to_csv writes files in text mode, which translates new lines
+        text = text.replace('\n', os.linesep)
+    data = text.encode('utf-8')
+    if compression == 'gzip':
+        return gzip.compress(data, compresslevel=level)
+    if compression == 'zstd':
+        return zstandard.ZstdCompressor(level=level).compress(data)
+    return data
+
+
+class ParallelCsvWriter:
+    """
+    Writes a frame that arrives in chunks to one csv file. Each chunk is
+    split into blocks of block_rows rows that are formatted, and optionally
+    compressed, on the executor while earlier blocks are written in order.
+    Without compression the file is byte for byte what to_csv writes for
+    the concatenated frame. Without an executor the blocks are formatted in
+    the calling thread; with one, workers should be its number of workers
+    """
+
+    def __init__(self, path: str, executor: Any = None,
+                 compression: Optional[str] = None,
+                 level: Optional[int] = None,
+                 block_rows: int = 50000, workers: int = 1) -> None:
+        if compression not in EXTENSIONS:
+            raise ValueError('Unknown csv compression: ' + str(compression))
+        if compression == 'zstd' and zstandard is None:
+            raise ImportError('zstd compression needs the zstandard package')
+        self.executor = executor
+        self.compression = compression
+        if level is None:
+            level = DEFAULT_LEVELS[compression] if compression else 0
+        self.level = level
+        self.block_rows = block_rows
+        # bound the blocks held in memory waiting to be formatted or written
+        self.max_pending = 2 * workers
+        self.pending = collections.deque()  # type: collections.deque
+        self.header = True
+        self.file = open(path, 'wb')
+
+    def _submit(self, block: pandas.DataFrame) -> None:
+        args = (block, self.header, self.compression, self.level)
+        self.header = False
+        if self.executor is None:
+            self.file.write(format_block(*args))
+            return
+        self.pending.append(self.executor.submit(format_block, *args))
+        while len(self.pending) > self.max_pending:
+            self.file.write(self.pending.popleft().result())
+
+    def write(self, frame: pandas.DataFrame) -> None:
+        if frame.empty:
+            if self.header:
+                self._submit(frame)
+            return
+        for start in range(0, len(frame.index), self.block_rows):
+            self._submit(frame.iloc[start:start + self.block_rows])
+
+    def close(self) -> None:
+        try:
+            while self.pending:
+                self.file.write(self.pending.popleft().result())
+        finally:
+            for future in self.pending:
+                future.cancel()
+            self.file.close()
+
+    def __enter__(self) -> 'ParallelCsvWriter':
+        return self
+
+    def __exit__(self, *exc_info: Any) -> None:
+        self.close()
+
+
+def csv_workers(cfg: Any) -> int:
+    """
+    Blocks are formatted in the calling thread unless csv_workers is set
+    """
+    return getattr(cfg, 'csv_workers', 1)
+
+
+def open_executor(cfg: Any) -> Any:
+    """
+    csv_workers in the configuration sets how many blocks are formatted at
+    once, in processes by default since to_csv holds the GIL for most of
+    its work; csv_executor = 'thread' uses threads instead.
+    The pool starts its processes when the first block is submitted, when
+    the prefetch thread may hold locks that a forked process would inherit
+    held, so the processes are spawned. Python 3.6 cannot spawn them, there
+    they are all forked here, before the sweep starts any thread
+    """
+    workers = csv_workers(cfg)
+    if workers <= 1:
+        return None
+    if getattr(cfg, 'csv_executor', 'process') == 'thread':
+        return concurrent.futures.ThreadPoolExecutor(workers)
+    try:
+        return concurrent.futures.ProcessPoolExecutor(
+            workers, mp_context=multiprocessing.get_context('spawn'))
+    except TypeError:
+        executor = concurrent.futures.ProcessPoolExecutor(workers)
+        executor.submit(int).result()
+        return executor
@@ -4,7 +4,8 @@ import logging
 import pandas
 import numpy as np
 import sql_functions
-from typing import Tuple, List, Any
+import profiling
+from typing import Any, Iterator, List, Optional, Tuple
 
 
 class ArbinTime:
@@ -33,21 +34,20 @@ def fill_times(row):
     For each step the date time value is set to be the date time
     value of the first preceding row that has a step index
     This function then subtracts the date time for each row
-    and returns that value, which should be the step time
+    and returns that value, which should be the step time.
+    Works on a whole frame as well as on a single row
     """
     return row['DateTime'] - row['Step_Time']
 
 
-def pull_and_join(cfg: Any, test_id: int, channel: int, starts: List,
-                  stops: List,
-                  dbs: List) -> Tuple[pandas.DataFrame, float, float]:
+def iter_db_frames(cfg: Any, channel: int, starts: List, stops: List,
+                   dbs: List, profiler: Any = profiling.NULL_PROFILER) \
+                   -> Iterator[pandas.DataFrame]:
     """
-    This is the primary data manipulation function. It calls the sql query
-    functions and joins the returned data frames. Based on the step and cycle
-    date time entries it fills in step time and test time. It also fills
-    in values in columns that do not have a value for that time stamp.
+    Calls the sql query functions for each result database in turn and
+    joins the returned data frames into one frame per database, in time
+    order. Step time and the missing values are filled in by JoinedFrames
     """
-    db_frames = []
     listed_windows = list(zip(starts, stops, dbs))
     arbin_time = ArbinTime()
     for window_index, window in enumerate(listed_windows):
@@ -57,91 +57,164 @@ def pull_and_join(cfg: Any, test_id: int, channel: int, starts: List,
         set_test_start_flag = True
         for db_index, db in enumerate(window[2].split(',')[:-1]):
             logging.info('Getting data from:' + db)
-            for i in range(cfg.ATTEMPTS):
-                try:
-                    connection, cursor = sql_functions.db_connect(cfg, db)
-                    steps_frame = sql_functions.find_steps(
-                        connection, channel, arbin_time.query(start),
-                        arbin_time.query(stop))
-                    raw_frame = sql_functions.find_raw_data(
-                        connection, channel, arbin_time.query(start),
-                        arbin_time.query(stop))
-                    aux_frame = sql_functions.find_auxiliary_data(
-                        connection, channel, arbin_time.query(start),
-                        arbin_time.query(stop))
-                except pypyodbc.OperationalError:
-                    logging.warning('Database read error')
-                    continue
-                except UnboundLocalError:
-                    logging.warning('Unknown database read error')
-                    continue
-                else:
-                    connection.close()
-                break
+            with profiler.stage('query ' + db):
+                for i in range(cfg.ATTEMPTS):
+                    try:
+                        connection, cursor = sql_functions.db_connect(cfg, db)
+                        steps_frame = sql_functions.find_steps(
+                            connection, channel, arbin_time.query(start),
+                            arbin_time.query(stop))
+                        raw_frame = sql_functions.find_raw_data(
+                            connection, channel, arbin_time.query(start),
+                            arbin_time.query(stop))
+                        aux_frame = sql_functions.find_auxiliary_data(
+                            connection, channel, arbin_time.query(start),
+                            arbin_time.query(stop))
+                    except pypyodbc.OperationalError:
+                        logging.warning('Database read error')
+                        continue
+                    except UnboundLocalError:
+                        logging.warning('Unknown database read error')
+                        continue
+                    else:
+                        connection.close()
+                    break
             logging.info('Done getting info from: ' + db)
 
             if raw_frame.empty or steps_frame.empty:
                 db_offset = db_offset + 1  # to deal with empty data frame and set start time correctly
                 continue
 
-            if not aux_frame.empty:
-                aux_frame = aux_interpolate(raw_frame.index, aux_frame)
-            else:
-                blank_data = {
-                    'date_time': pandas.Series(raw_frame.index[0], index=[0]),
-                    'Temperature': pandas.Series(np.NaN, index=[0]),
-                    'Aux_Voltage': pandas.Series(np.NaN, index=[0])
-                }
-                aux_frame = pandas.DataFrame(blank_data)
-
-            set_frame = pandas.concat(
-                [raw_frame, steps_frame, aux_frame], axis=1, join='outer')
-            set_frame.reset_index(inplace=True)
-
-            # if db_index == 0:
-            #     start_time = steps_frame.index[0]
-            if db_index == (0 + db_offset) and window_index == 0 and set_test_start_flag:
-                start_time = steps_frame.index[0]
-                set_test_start_flag = False
-
-            set_frame['Test_Time'] = arbin_time.to_epoch(
-                set_frame.date_time - start_time)
-            set_frame['Step_Time'] = arbin_time.to_epoch(set_frame.date_time)
-            set_frame.date_time = arbin_time.to_epoch(set_frame.date_time)
-            set_frame.loc[set_frame.Step_Index.isnull(), 'Step_Time'] = np.NaN
-            set_frame['AC_Impedance'] = 0
-            set_frame['Is_FC_Data'] = 0
-            set_frame['ACI_Phase_Angle'] = 0
-            set_frame.rename(columns={'date_time': 'DateTime'}, inplace=True)
-            cols = [
-                'Test_Time', 'DateTime', 'Step_Time', 'Step_Index',
-                'Cycle_Index', 'Current', 'Voltage', 'Charge_Capacity',
-                'Discharge_Capacity', 'Charge_Energy', 'Discharge_Energy',
-                'dV/dt', 'Internal_Resistance', 'Temperature', 'Aux_Voltage'
-            ]
-            db_frames.append(set_frame[cols])
-
-    query_last_time = max(stops)
-
-    if not db_frames:
-        logging.warning(
-            'No data for test id:' + str(test_id) + ' channel:' + str(channel))
-        return pandas.DataFrame(
-            columns=['DateTime', 'Cycle_Index']), query_last_time, 0
-
-    full_test_frame = pandas.concat(db_frames, ignore_index=True)
-    full_test_frame.fillna(method='ffill', inplace=True)
-    full_test_frame = full_test_frame[np.isfinite(
-        full_test_frame['Step_Index'])]
-    full_test_frame.Step_Time = full_test_frame.apply(fill_times, axis=1)
-    full_test_frame = full_test_frame[full_test_frame.Step_Time != 0]
+            with profiler.stage('join ' + db):
+                if not aux_frame.empty:
+                    aux_frame = aux_interpolate(raw_frame.index, aux_frame)
+                else:
+                    blank_data = {
+                        'date_time': pandas.Series(raw_frame.index[0],
+                                                   index=[0]),
+                        'Temperature': pandas.Series(np.NaN, index=[0]),
+                        'Aux_Voltage': pandas.Series(np.NaN, index=[0])
+                    }
+                    aux_frame = pandas.DataFrame(blank_data)
+
+                set_frame = pandas.concat(
+                    [raw_frame, steps_frame, aux_frame], axis=1, join='outer')
+                set_frame.reset_index(inplace=True)
+
+                # if db_index == 0:
+                #     start_time = steps_frame.index[0]
+                if db_index == (0 + db_offset) and window_index == 0 \
+                        and set_test_start_flag:
+                    start_time = steps_frame.index[0]
+                    set_test_start_flag = False
+
+                set_frame['Test_Time'] = arbin_time.to_epoch(
+                    set_frame.date_time - start_time)
+                set_frame['Step_Time'] = arbin_time.to_epoch(
+                    set_frame.date_time)
+                set_frame.date_time = arbin_time.to_epoch(set_frame.date_time)
+                set_frame.loc[set_frame.Step_Index.isnull(),
+                              'Step_Time'] = np.NaN
+                set_frame['AC_Impedance'] = 0
+                set_frame['Is_FC_Data'] = 0
+                set_frame['ACI_Phase_Angle'] = 0
+                set_frame.rename(columns={'date_time': 'DateTime'},
+                                 inplace=True)
+                cols = [
+                    'Test_Time', 'DateTime', 'Step_Time', 'Step_Index',
+                    'Cycle_Index', 'Current', 'Voltage', 'Charge_Capacity',
+                    'Discharge_Capacity', 'Charge_Energy', 'Discharge_Energy',
+                    'dV/dt', 'Internal_Resistance', 'Temperature',
+                    'Aux_Voltage'
+                ]
+                yield set_frame[cols]
+
+
+class JoinedFrames:
+    """
+    This is the primary data manipulation step. The frame from each result
+    database is finished as soon as it is pulled and yielded as a chunk of
+    the full test. Based on the step and cycle date time entries it fills
+    in step time and test time. It also fills in values in columns that do
+    not have a value for that time stamp, carrying the last values over
+    from the previous chunk, and numbers the rows with Data_Point across
+    chunks. The chunks are the same rows as the frame from pull_and_join,
+    but only one database is held in memory at a time.
+    It can only be iterated once. length is the number of data points
+    yielded so far; query_last_time is the end of the last window.
+    Each stage is reported to the profiler, which does nothing by default.
+    """
+
+    def __init__(self, cfg: Any, test_id: int, channel: int, starts: List,
+                 stops: List, dbs: List,
+                 profiler: Any = profiling.NULL_PROFILER) -> None:
+        self.cfg = cfg
+        self.test_id = test_id
+        self.channel = channel
+        self.starts = starts
+        self.stops = stops
+        self.dbs = dbs
+        self.profiler = profiler
+        self.query_last_time = max(stops)
+        self.length = 0
+        self._started = False
+
+    def __iter__(self) -> Iterator[pandas.DataFrame]:
+        if self._started:
+            raise RuntimeError('JoinedFrames can only be iterated once')
+        self._started = True
+        last_row = None
+        for db_frame in iter_db_frames(self.cfg, self.channel, self.starts,
+                                       self.stops, self.dbs, self.profiler):
+            with self.profiler.stage('fill'):
+                chunk, last_row = finish_chunk(db_frame, last_row,
+                                               self.length)
+            self.length += len(chunk.index)
+            yield chunk
+        if last_row is None:
+            logging.warning('No data for test id:' + str(self.test_id) +
+                            ' channel:' + str(self.channel))
+            yield pandas.DataFrame(columns=['DateTime', 'Cycle_Index'])
+
+
+def finish_chunk(db_frame: pandas.DataFrame, last_row: Optional[pandas.Series],
+                 first_data_point: int) \
+                 -> Tuple[pandas.DataFrame, pandas.Series]:
+    """
+    Forward fill a chunk of the test, starting from the last row of the
+    previous chunk after its forward fill, and drop the rows that were
+    only there to mark the steps. Returns the finished chunk and its own
+    last row, to carry over to the next chunk
+    """
+    chunk = db_frame.reset_index(drop=True).ffill()
+    if last_row is not None:
+        chunk = chunk.fillna(last_row)
+    last_row = chunk.iloc[-1]
+    chunk = chunk[np.isfinite(chunk['Step_Index'])]
+    chunk.Step_Time = fill_times(chunk)
+    chunk = chunk[chunk.Step_Time != 0]
     # delete the rows that were inserted by steps frame
-    full_test_frame.reset_index(drop=True, inplace=True)
-    full_test_frame.index.name = 'Data_Point'
-    full_test_frame = full_test_frame.round({'Step_Time': 4})
-    full_test_frame['Step_Index'] = full_test_frame.Step_Index.astype('int')
-    full_test_frame['Cycle_Index'] = full_test_frame.Cycle_Index.astype('int')
-    return full_test_frame, query_last_time, len(full_test_frame.index)
+    chunk.index = pandas.RangeIndex(
+        first_data_point, first_data_point + len(chunk.index),
+        name='Data_Point')
+    chunk = chunk.round({'Step_Time': 4})
+    chunk['Step_Index'] = chunk.Step_Index.astype('int')
+    chunk['Cycle_Index'] = chunk.Cycle_Index.astype('int')
+    return chunk, last_row
+
+
+def pull_and_join(cfg: Any, test_id: int, channel: int, starts: List,
+                  stops: List, dbs: List,
+                  profiler: Any = profiling.NULL_PROFILER) \
+                  -> Tuple[pandas.DataFrame, float, float]:
+    """
+    The whole test as one frame, for callers that do not stream the chunks
+    """
+    joined_frames = JoinedFrames(cfg, test_id, channel, starts, stops, dbs,
+                                 profiler)
+    full_test_frame = pandas.concat(list(joined_frames))
+    return full_test_frame, joined_frames.query_last_time, \
+        joined_frames.length
 
 
 def pull_meta_data(cfg: Any, test_name_channel_test_id: int,
@@ -0,0 +1,227 @@
+# Copyright 2018 Toyota Research Institute. All rights reserved.
+import os
+import sys
+import socket
+import csv
+import time
+import datetime
+import threading
+import tracemalloc
+import contextlib
+import collections
+from typing import Any, Dict, Iterator, List, Optional
+
+
+class NullProfiler:
+    """
+    Stand-in used when profiling is off so callers do not need to branch
+    """
+
+    @contextlib.contextmanager
+    def channel(self, name: str) -> Iterator[None]:
+        yield
+
+    @contextlib.contextmanager
+    def stage(self, name: str) -> Iterator[None]:
+        yield
+
+    def summarize(self) -> None:
+        pass
+
+
+NULL_PROFILER = NullProfiler()
+
+
+class StackSampler(threading.Thread):
+    """
+    Sampling CPU profiler for a single thread. Every interval the stack of
+    the target thread is read and counted against the function it is in
+    (self samples) and every function on the stack (cumulative samples).
+    The overhead does not depend on how many calls the profiled code makes
+    """
+
+    def __init__(self, thread_id: int, interval: float) -> None:
+        super().__init__(daemon=True)
+        self.thread_id = thread_id
+        self.interval = interval
+        self.samples = 0
+        self.self_counts = collections.Counter()  # type: collections.Counter
+        self.cumulative_counts = \
+            collections.Counter()  # type: collections.Counter
+        self._stop_event = threading.Event()
+
+    def run(self) -> None:
+        while not self._stop_event.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None:
+                continue
+            self.samples += 1
+            self.self_counts[self._label(frame)] += 1
+            seen = set()
+            while frame is not None:
+                label = self._label(frame, lineno=False)
+                if label not in seen:
+                    self.cumulative_counts[label] += 1
+                    seen.add(label)
+                frame = frame.f_back
+
+    @staticmethod
+    def _label(frame: Any, lineno: bool = True) -> str:
+        code = frame.f_code
+        if lineno:
+            return '{}:{} {}'.format(code.co_filename, frame.f_lineno,
+                                     code.co_name)
+        return '{}:{} {}'.format(code.co_filename, code.co_firstlineno,
+                                 code.co_name)
+
+    def stop(self) -> None:
+        self._stop_event.set()
+        self.join()
+
+    def report(self, top: int) -> List[str]:
+        lines = ['samples: {} interval: {}s'.format(self.samples,
+                                                    self.interval), '',
+                 'self samples:']
+        for label, count in self.self_counts.most_common(top):
+            lines.append('{:8d} {}'.format(count, label))
+        lines += ['', 'cumulative samples:']
+        for label, count in self.cumulative_counts.most_common(top):
+            lines.append('{:8d} {}'.format(count, label))
+        return lines
+
+
+class SweepProfiler:
+    """
+    Memory and CPU profile of each test-channel in a sweep, written to
+    a directory per sweep:
+        <channel>_stages.csv  wall time, cpu time and peak memory per stage
+        <channel>_memory.txt  top allocations at the largest stage exit
+        <channel>_cpu.txt     sampled cpu profile of the channel
+        summary.csv           channels ranked by peak memory and cpu time
+    Memory is measured with tracemalloc, which only sees allocations made
+    through Python (numpy and pandas buffers included) and is process wide,
+    so channels have to be converted one at a time to be attributed.
+    cpu time is that of this process only: csv blocks formatted on a
+    process pool (csv_executor = 'process') are not counted, set
+    csv_executor = 'thread' to include them.
+    """
+
+    def __init__(self, folder: str, interval: float = 0.01,
+                 top: int = 25) -> None:
+        # sharded workers can share the folder and start in the same second
+        base = os.path.join(folder, 'sweep_{}_{}_{}'.format(
+            datetime.datetime.now().strftime('%Y-%m-%d_%H%M%S'),
+            socket.gethostname(), os.getpid()))
+        self.folder = base
+        suffix = 1
+        while True:
+            try:
+                os.makedirs(self.folder)
+                break
+            except FileExistsError:
+                suffix += 1
+                self.folder = base + '_' + str(suffix)
+        self.interval = interval
+        self.top = top
+        self.channels = []  # type: List[Dict]
+        self.current = None  # type: Optional[Dict]
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    @contextlib.contextmanager
+    def channel(self, name: str) -> Iterator[None]:
+        tracemalloc.clear_traces()
+        self.current = {'name': name, 'stages': [], 'snapshot': None,
+                        'snapshot_size': -1, 'peak': 0}
+        sampler = StackSampler(threading.get_ident(), self.interval)
+        sampler.start()
+        start_wall, start_cpu = time.perf_counter(), time.process_time()
+        try:
+            yield
+        finally:
+            sampler.stop()
+            current = self.current
+            self.current = None
+            current['wall'] = time.perf_counter() - start_wall
+            current['cpu'] = time.process_time() - start_cpu
+            current['peak'] = max(
+                [current['peak'], tracemalloc.get_traced_memory()[1]] +
+                [stage['peak'] for stage in current['stages']])
+            self._write_channel(current, sampler)
+            del current['snapshot']
+            self.channels.append(current)
+
+    @contextlib.contextmanager
+    def stage(self, name: str) -> Iterator[None]:
+        if self.current is None:
+            yield
+            return
+        if hasattr(tracemalloc, 'reset_peak'):
+            # keep the peak reached between stages, such as writing the
+            # chunks while the join is paused, before starting a new one
+            self.current['peak'] = max(self.current['peak'],
+                                       tracemalloc.get_traced_memory()[1])
+            tracemalloc.reset_peak()
+        start_wall, start_cpu = time.perf_counter(), time.process_time()
+        try:
+            yield
+        finally:
+            size, peak = tracemalloc.get_traced_memory()
+            self.current['stages'].append({
+                'stage': name,
+                'wall': time.perf_counter() - start_wall,
+                'cpu': time.process_time() - start_cpu,
+                'size': size,
+                'peak': peak
+            })
+            if size > self.current['snapshot_size']:
+                self.current['snapshot'] = tracemalloc.take_snapshot()
+                self.current['snapshot_size'] = size
+
+    def _path(self, channel_name: str, suffix: str) -> str:
+        return os.path.join(self.folder, channel_name + suffix)
+
+    def _write_channel(self, current: Dict, sampler: StackSampler) -> None:
+        name = current['name']
+        with open(self._path(name, '_stages.csv'), 'w', newline='') as f:
+            writer = csv.DictWriter(
+                f, fieldnames=['stage', 'wall', 'cpu', 'size', 'peak'])
+            writer.writeheader()
+            writer.writerows(current['stages'])
+        snapshot = current['snapshot'] or tracemalloc.take_snapshot()
+        with open(self._path(name, '_memory.txt'), 'w') as f:
+            f.write('peak: {} bytes\n\n'.format(current['peak']))
+            for stat in snapshot.statistics('lineno')[:self.top]:
+                f.write(str(stat) + '\n')
+        with open(self._path(name, '_cpu.txt'), 'w') as f:
+            f.write('\n'.join(sampler.report(self.top)) + '\n')
+
+    def summarize(self) -> None:
+        """
+        Rank the channels of the sweep by peak memory, with the cpu rank
+        alongside, to find the tests that drive the memory needed
+        """
+        by_cpu = sorted(self.channels, key=lambda x: x['cpu'], reverse=True)
+        cpu_rank = {id(ch): rank + 1 for rank, ch in enumerate(by_cpu)}
+        by_peak = sorted(self.channels, key=lambda x: x['peak'],
+                         reverse=True)
+        with open(os.path.join(self.folder, 'summary.csv'), 'w',
+                  newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(['channel', 'peak_bytes', 'peak_rank', 'cpu',
+                             'cpu_rank', 'wall'])
+            for rank, ch in enumerate(by_peak):
+                writer.writerow([ch['name'], ch['peak'], rank + 1,
+                                 round(ch['cpu'], 3), cpu_rank[id(ch)],
+                                 round(ch['wall'], 3)])
+
+
+def open_profiler(cfg: Any) -> Any:
+    """
+    Profiling is opt-in, set profile_folder in the configuration to turn
+    it on for a sweep
+    """
+    folder = getattr(cfg, 'profile_folder', None)
+    if not folder:
+        return NULL_PROFILER
+    return SweepProfiler(folder, getattr(cfg, 'profile_interval', 0.01))
@@ -2,7 +2,7 @@
 import pypyodbc
 import pandas
 import numpy as np
-from typing import Tuple, List, Any
+from typing import Dict, Tuple, List, Any
 import logging
 
 
@@ -263,3 +263,38 @@ def find_meta_data(connection: Any, test_id: int,
     params = [test_id, iv_ch_id]
     total_data = pandas.read_sql(sql_cmd, connection, params=params)
     return total_data
+
+
+def find_channel_fingerprints(c: Any) -> Dict[Tuple[int, int], List]:
+    """
+    Get the last end time and the result databases for every test id and
+    channel in a single query. These only change while a test is running,
+    so they are used to skip channels without touching the result databases
+    """
+    sql_cmd = """SELECT Test_ID, IV_Ch_ID, Last_End_DateTime, Databases
+                 FROM TestIVChList_Table
+                 ORDER BY Test_ID, IV_Ch_ID, First_Start_DateTime;"""
+    c.execute(sql_cmd)
+    fingerprints = {}  # type: Dict[Tuple[int, int], List]
+    for test_id, chan_id, last_end, databases in c.fetchall():
+        fingerprints.setdefault((int(test_id), int(chan_id)), []).append(
+            (last_end, databases))
+    return fingerprints
+
+
+def find_channel_watermark(c: Any, channel_id: int) -> Tuple:
+    """
+    Get the latest raw data and event time stamps for a channel in a result
+    database. Any new data for the channel moves one of these forward.
+    Both are seeks on the channel and date time index of the tables
+    """
+    sql_cmd = """SELECT
+                     (SELECT MAX(date_time)
+                      FROM Channel_RawData_Table
+                      WHERE channel_id = ?),
+                     (SELECT MAX(Date_Time)
+                      FROM Event_Table
+                      WHERE Channel_ID = ?);"""
+    params = [channel_id, channel_id]
+    c.execute(sql_cmd, params)
+    return tuple(c.fetchone())
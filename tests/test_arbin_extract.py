@@ -0,0 +1,82 @@
+# Copyright 2018 Toyota Research Institute. All rights reserved.
+import os
+import threading
+import numpy as np
+import pandas
+import pytest
+import arbin_extract
+import channel_store
+
+
+def joined_frame(n_rows: int, first_date_time: float) -> pandas.DataFrame:
+    frame = pandas.DataFrame({
+        name: np.arange(n_rows, dtype=float)
+        for name, dtype in channel_store.COLUMNS
+    })
+    frame['DateTime'] += first_date_time
+    frame['Cycle_Index'] = np.arange(n_rows) // 3
+    frame.index.name = 'Data_Point'
+    return frame
+
+
+def tee(path, frame, test_id, new_test=False):
+    chunks = [frame.iloc[:4], frame.iloc[4:]]
+    list(arbin_extract.tee_channel_store(path, chunks, test_id, new_test))
+    return channel_store.ChannelStore(path)
+
+
+def stored(store, name):
+    return store.read()[name].tolist()
+
+
+def test_channel_store_is_rebuilt_for_another_test(tmpdir):
+    path = os.path.join(str(tmpdir), 'test_CH1')
+    first_test = joined_frame(8, 1.5e9)
+    assert tee(path, first_test.iloc[:5], 2).n_rows == 5
+    store = tee(path, first_test, 2)
+    assert stored(store, 'DateTime') == first_test['DateTime'].tolist()
+
+    # a test name reused by a later test
+    second_test = joined_frame(10, 1.6e9)
+    store = tee(path, second_test, 3)
+    assert stored(store, 'DateTime') == second_test['DateTime'].tolist()
+    assert store.is_test(3, 1.6e9)
+
+    # a new test is always written from the start
+    second_test['Voltage'] = 4.2
+    store = tee(path, second_test, 3, new_test=True)
+    assert stored(store, 'Voltage') == [4.2] * 10
+
+
+def test_prefetch_yields_in_order():
+    assert list(arbin_extract.prefetch(range(10), 2)) == list(range(10))
+    assert list(arbin_extract.prefetch(range(3), 0)) == [0, 1, 2]
+
+
+def test_prefetch_reraises_in_consumer():
+    def source():
+        yield 1
+        raise ValueError('Database read error')
+
+    with pytest.raises(ValueError):
+        list(arbin_extract.prefetch(source(), 1))
+
+
+def test_prefetch_stops_producer_when_consumer_stops():
+    closed = threading.Event()
+
+    def source():
+        try:
+            for item in range(1000):
+                yield item
+        finally:
+            closed.set()
+
+    threads = threading.active_count()
+    items = arbin_extract.prefetch(source(), 2)
+    for item in items:
+        if item == 3:
+            break
+    items.close()
+    assert closed.is_set()
+    assert threading.active_count() == threads
@@ -0,0 +1,138 @@
+# Copyright 2018 Toyota Research Institute. All rights reserved.
+import os
+import time
+import pypyodbc
+import change_detection
+import data_join
+import sql_functions
+
+
+class StubConfig:
+    ATTEMPTS = 2
+
+    def __init__(self, folder: str) -> None:
+        self.path_to_completed_list = os.path.join(folder, 'converted')
+
+
+class StubCursor:
+    """
+    Answers the master table query with rows and every watermark query
+    with watermark, counting the watermark queries
+    """
+
+    def __init__(self, rows, watermark=None) -> None:
+        self.rows = rows
+        self.watermark = watermark
+        self.watermark_queries = 0
+
+    def execute(self, sql_cmd, params=None):
+        if params is not None:
+            self.watermark_queries += 1
+
+    def fetchall(self):
+        return self.rows
+
+    def fetchone(self):
+        return self.watermark
+
+
+class StubConnection:
+    def close(self):
+        pass
+
+
+def arbin_timestamp(seconds_ago: float) -> int:
+    return data_join.ArbinTime().query(time.time() - seconds_ago)
+
+
+def sweep(monkeypatch, tmpdir, watermark, fail=False):
+    master = StubCursor([(2, 43, 1.5e9, 'ArbinResult_1,ArbinResult_2,')])
+    result = StubCursor(None, watermark)
+
+    def db_connect(cfg, db):
+        assert db == 'ArbinResult_2'
+        if fail:
+            raise pypyodbc.OperationalError('Database read error')
+        return StubConnection(), result
+
+    monkeypatch.setattr(sql_functions, 'db_connect', db_connect)
+    fingerprints = change_detection.open_fingerprints(
+        StubConfig(str(tmpdir)), master)
+    return fingerprints, result
+
+
+def test_unchanged_channel_is_skipped(monkeypatch, tmpdir):
+    watermark = (arbin_timestamp(60), arbin_timestamp(30))
+    fingerprints, result = sweep(monkeypatch, tmpdir, watermark)
+    assert not fingerprints.unchanged('script_test_CH44', 2, 43)
+    fingerprints.mark('script_test_CH44')
+    fingerprints.save()
+
+    fingerprints, result = sweep(monkeypatch, tmpdir, watermark)
+    assert fingerprints.unchanged('script_test_CH44', 2, 43)
+    assert result.watermark_queries == 1
+
+
+def test_changed_channel_is_checked(monkeypatch, tmpdir):
+    fingerprints, result = sweep(monkeypatch, tmpdir,
+                                 (arbin_timestamp(60), arbin_timestamp(30)))
+    fingerprints.unchanged('script_test_CH44', 2, 43)
+    fingerprints.mark('script_test_CH44')
+    fingerprints.save()
+
+    fingerprints, result = sweep(monkeypatch, tmpdir,
+                                 (arbin_timestamp(1), arbin_timestamp(30)))
+    assert not fingerprints.unchanged('script_test_CH44', 2, 43)
+    assert not fingerprints.unchanged('script_test_CH1', 2, 0)
+
+
+def test_read_failure_is_checked(monkeypatch, tmpdir):
+    fingerprints, result = sweep(monkeypatch, tmpdir, None, fail=True)
+    assert not fingerprints.unchanged('script_test_CH44', 2, 43)
+    fingerprints.mark('script_test_CH44')
+    assert fingerprints.saved == {}
+
+
+def test_stable_channel_skips_result_database(monkeypatch, tmpdir):
+    watermark = (arbin_timestamp(30 * 24 * 3600), None)
+    fingerprints, result = sweep(monkeypatch, tmpdir, watermark)
+    fingerprints.unchanged('script_test_CH44', 2, 43)
+    fingerprints.mark('script_test_CH44')
+    fingerprints.save()
+
+    fingerprints, result = sweep(monkeypatch, tmpdir, watermark, fail=True)
+    assert fingerprints.unchanged('script_test_CH44', 2, 43)
+
+
+def test_channel_is_checked_after_an_outage(monkeypatch, tmpdir):
+    days = 24 * 3600
+    fingerprints, result = sweep(monkeypatch, tmpdir,
+                                 (arbin_timestamp(8 * days), None))
+    fingerprints.unchanged('script_test_CH44', 2, 43)
+    fingerprints.mark('script_test_CH44')
+    # saved right after the last data, then no sweep for 8 days
+    rows, marks, saved_at, skipped = fingerprints.saved['script_test_CH44']
+    fingerprints.saved['script_test_CH44'] = \
+        (rows, marks, saved_at - 8 * days + 60, skipped)
+    fingerprints.save()
+
+    fingerprints, result = sweep(monkeypatch, tmpdir,
+                                 (arbin_timestamp(60), None))
+    assert not fingerprints.unchanged('script_test_CH44', 2, 43)
+    assert result.watermark_queries == 1
+
+
+def test_stable_channel_is_rechecked(monkeypatch, tmpdir):
+    watermark = (arbin_timestamp(30 * 24 * 3600), None)
+    fingerprints, result = sweep(monkeypatch, tmpdir, watermark)
+    fingerprints.unchanged('script_test_CH44', 2, 43)
+    fingerprints.mark('script_test_CH44')
+    fingerprints.save()
+
+    queries = []
+    for i in range(20):
+        fingerprints, result = sweep(monkeypatch, tmpdir, watermark)
+        assert fingerprints.unchanged('script_test_CH44', 2, 43)
+        fingerprints.save()
+        queries.append(result.watermark_queries)
+    assert queries == ([0] * 9 + [1]) * 2
@@ -0,0 +1,70 @@
+# Copyright 2018 Toyota Research Institute. All rights reserved.
+import os
+import numpy as np
+import pandas
+import channel_store
+
+
+def example_frame(n_rows: int) -> pandas.DataFrame:
+    frame = pandas.DataFrame({
+        name: np.arange(n_rows, dtype=float)
+        for name, dtype in channel_store.COLUMNS
+    })
+    frame['Step_Index'] = 1
+    frame['Cycle_Index'] = [1, 1, 1, 2, 2, 3, 3, 3, 3, 4][:n_rows]
+    frame.index.name = 'Data_Point'
+    return frame
+
+
+def test_append_and_read_cycles(tmpdir):
+    path = os.path.join(str(tmpdir), 'test_CH1')
+    full_test_frame = example_frame(10)
+    store = channel_store.ChannelStore(path)
+    store.append(full_test_frame.iloc[:4])
+    store = channel_store.ChannelStore(path)
+    store.append(full_test_frame.iloc[store.n_rows:])
+    assert store.n_rows == 10
+    assert store.cycle_index()['Data_Point'].tolist() == [0, 3, 5, 9]
+    assert store.read(2, 3)['Cycle_Index'].tolist() == [2, 2, 3, 3, 3, 3]
+    assert store.to_frame(3).index.tolist() == [5, 6, 7, 8, 9]
+    assert store.read(7, 9).shape == (0,)
+
+
+def test_csv_matches_joined_frame(tmpdir):
+    path = os.path.join(str(tmpdir), 'test_CH1')
+    full_test_frame = example_frame(10)
+    store = channel_store.ChannelStore(path)
+    store.append(full_test_frame)
+    store.to_csv(path + '_store.csv')
+    full_test_frame.to_csv(path + '.csv')
+    with open(path + '_store.csv') as f1, open(path + '.csv') as f2:
+        assert f1.read() == f2.read()
+
+
+def test_truncate(tmpdir):
+    path = os.path.join(str(tmpdir), 'test_CH1')
+    store = channel_store.ChannelStore(path)
+    store.append(example_frame(10))
+    store.truncate(4)
+    assert store.n_rows == 4
+    assert store.cycle_index()['Cycle_Index'].tolist() == [1, 2]
+    store.append(example_frame(10).iloc[4:])
+    assert store.read()['Cycle_Index'].tolist() == \
+        example_frame(10)['Cycle_Index'].tolist()
+
+
+def test_interrupted_append(tmpdir):
+    path = os.path.join(str(tmpdir), 'test_CH1')
+    full_test_frame = example_frame(10)
+    store = channel_store.ChannelStore(path)
+    store.append(full_test_frame.iloc[:4])
+    # crash after the index was written but before the records were
+    store.append(full_test_frame.iloc[4:])
+    with open(store.data_path, 'r+b') as f:
+        f.truncate(store.header_size + 4 * store.dtype.itemsize + 7)
+    store = channel_store.ChannelStore(path)
+    assert store.n_rows == 4
+    assert store.cycle_index()['Data_Point'].tolist() == [0, 3]
+    store.append(full_test_frame.iloc[store.n_rows:])
+    assert store.read(3)['Cycle_Index'].tolist() == [3, 3, 3, 3, 4]
+    assert store.cycle_index()['Data_Point'].tolist() == [0, 3, 5, 9]
@@ -0,0 +1,77 @@
+# Copyright 2018 Toyota Research Institute. All rights reserved.
+import os
+import socket
+import time
+import coordination
+
+
+def test_lease_claiming(tmpdir):
+    path = os.path.join(str(tmpdir), 'leases.sqlite')
+    worker_a = coordination.LeaseStore(path, 'worker_a', lease_seconds=60)
+    worker_b = coordination.LeaseStore(path, 'worker_b', lease_seconds=60)
+    assert worker_a.claim('test_CH1')
+    assert worker_a.claim('test_CH1')
+    assert not worker_b.claim('test_CH1')
+    assert worker_b.claim('test_CH2')
+    worker_a.release('test_CH1')
+    assert worker_b.claim('test_CH1')
+    worker_a.close()
+    worker_b.close()
+
+
+def test_expired_lease_is_taken_over(tmpdir):
+    path = os.path.join(str(tmpdir), 'leases.sqlite')
+    lost_worker = coordination.LeaseStore(path, 'lost', lease_seconds=0.01)
+    worker = coordination.LeaseStore(path, 'worker', lease_seconds=60)
+    assert lost_worker.claim('test_CH1')
+    time.sleep(0.05)
+    assert worker.claim('test_CH1')
+    assert not lost_worker.renew('test_CH1')
+    assert not lost_worker.record_converted('test_CH1', 100.0, 10)
+    assert worker.record_converted('test_CH1', 100.0, 10)
+    assert worker.record_converted('test_CH1', 200.0, 20)
+    assert lost_worker.converted() == {'test_CH1': (200.0, 20)}
+    lost_worker.close()
+    worker.close()
+
+
+def test_renewing_stops_on_lost_lease(tmpdir):
+    path = os.path.join(str(tmpdir), 'leases.sqlite')
+    lost_worker = coordination.LeaseStore(path, 'lost', lease_seconds=0.01)
+    worker = coordination.LeaseStore(path, 'worker', lease_seconds=60)
+    assert lost_worker.claim('test_CH1')
+    written = []
+    try:
+        for chunk in coordination.renewing(lost_worker, 'test_CH1',
+                                           [1, 2, 3]):
+            written.append(chunk)
+            time.sleep(0.05)
+            assert worker.claim('test_CH1')
+    except coordination.LeaseLost:
+        pass
+    else:
+        assert False, 'LeaseLost not raised'
+    assert written == [1]
+    lost_worker.close()
+    worker.close()
+
+
+def test_unique_temp_path():
+    path = coordination.unique_temp_path(os.path.join('data', 'test_CH1.csv'))
+    assert socket.gethostname() in path
+    assert str(os.getpid()) in path
+
+
+def test_converted_state_and_import(tmpdir):
+    path = os.path.join(str(tmpdir), 'leases.sqlite')
+    worker = coordination.LeaseStore(path, 'worker', lease_seconds=60)
+    assert worker.converted_state('test_CH1') is None
+    assert worker.import_converted({'test_CH1': (100.0, 10),
+                                    'test_CH2': (50.0, 5)}) == 2
+    assert worker.converted_state('test_CH1') == (100.0, 10)
+    assert worker.import_converted({'test_CH3': (10.0, 1)}) == 0
+    assert worker.converted_state('test_CH3') is None
+    assert worker.claim('test_CH1')
+    assert worker.record_converted('test_CH1', 200.0, 20)
+    assert worker.converted_state('test_CH1') == (200.0, 20)
+    worker.close()
@@ -0,0 +1,63 @@
+# Copyright 2018 Toyota Research Institute. All rights reserved.
+import os
+import gzip
+import concurrent.futures
+import numpy as np
+import pandas
+import csv_writer
+
+
+class StubConfig:
+    def __init__(self, **settings) -> None:
+        self.__dict__.update(settings)
+
+
+def example_frame(n_rows: int) -> pandas.DataFrame:
+    rng = np.random.RandomState(0)
+    frame = pandas.DataFrame(rng.rand(n_rows, 3),
+                             columns=['Test_Time', 'Current', 'Voltage'])
+    frame['Cycle_Index'] = np.arange(n_rows) // 7
+    frame.index.name = 'Data_Point'
+    return frame
+
+
+def test_matches_to_csv(tmpdir):
+    frame = example_frame(1000)
+    expected_path = os.path.join(str(tmpdir), 'expected.csv')
+    frame.to_csv(path_or_buf=expected_path)
+    with open(expected_path, 'rb') as f:
+        expected = f.read()
+    path = os.path.join(str(tmpdir), 'test.csv')
+    pools = [
+        concurrent.futures.ThreadPoolExecutor(4),
+        csv_writer.open_executor(StubConfig(csv_workers=4))
+    ]
+    for pool in [None] + pools:
+        with csv_writer.ParallelCsvWriter(path, pool, block_rows=64,
+                                          workers=4) as writer:
+            writer.write(frame.iloc[:300])
+            writer.write(frame.iloc[300:])
+        with open(path, 'rb') as f:
+            assert f.read() == expected
+    for pool in pools:
+        pool.shutdown()
+
+
+def test_gzip_stream(tmpdir):
+    frame = example_frame(1000)
+    path = os.path.join(str(tmpdir), 'test.csv.gz')
+    with concurrent.futures.ThreadPoolExecutor(4) as executor:
+        with csv_writer.ParallelCsvWriter(
+                path, executor, 'gzip', block_rows=64, workers=4) as writer:
+            writer.write(frame)
+    with gzip.open(path, 'rb') as f:
+        data = f.read()
+    assert data.decode('utf-8').replace(os.linesep, '\n') == frame.to_csv()
+
+
+def test_executor_is_opt_in():
+    assert csv_writer.open_executor(StubConfig()) is None
+    executor = csv_writer.open_executor(
+        StubConfig(csv_workers=2, csv_executor='thread'))
+    assert isinstance(executor, concurrent.futures.ThreadPoolExecutor)
+    executor.shutdown()
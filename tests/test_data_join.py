@@ -0,0 +1,54 @@
+# Copyright 2018 Toyota Research Institute. All rights reserved.
+import numpy as np
+import pandas
+import data_join
+
+COLUMNS = [
+    'Test_Time', 'DateTime', 'Step_Time', 'Step_Index', 'Cycle_Index',
+    'Current', 'Voltage', 'Charge_Capacity', 'Discharge_Capacity',
+    'Charge_Energy', 'Discharge_Energy', 'dV/dt', 'Internal_Resistance',
+    'Temperature', 'Aux_Voltage'
+]
+
+
+def example_db_frame(rng: np.random.RandomState, n_rows: int,
+                     start: float) -> pandas.DataFrame:
+    frame = pandas.DataFrame(rng.rand(n_rows, len(COLUMNS)), columns=COLUMNS)
+    frame['DateTime'] = start + np.arange(n_rows, dtype=float)
+    step = rng.rand(n_rows) < 0.1
+    step[0] = False
+    frame['Step_Index'] = np.where(step, rng.randint(1, 9, n_rows), np.nan)
+    frame['Cycle_Index'] = np.where(step, rng.randint(1, 9, n_rows), np.nan)
+    frame['Step_Time'] = np.where(step, frame['DateTime'], np.nan)
+    for name in ['Current', 'Voltage', 'Temperature']:
+        frame.loc[rng.rand(n_rows) < 0.3, name] = np.nan
+    return frame
+
+
+def test_chunks_match_full_join(monkeypatch):
+    rng = np.random.RandomState(0)
+    db_frames = [
+        example_db_frame(rng, n_rows, start)
+        for n_rows, start in [(50, 0), (30, 100), (5, 200), (40, 300)]
+    ]
+    full_test_frame = pandas.concat(db_frames, ignore_index=True).ffill()
+    full_test_frame = full_test_frame[np.isfinite(
+        full_test_frame['Step_Index'])]
+    full_test_frame.Step_Time = full_test_frame.apply(
+        data_join.fill_times, axis=1)
+    full_test_frame = full_test_frame[full_test_frame.Step_Time != 0]
+    full_test_frame.reset_index(drop=True, inplace=True)
+    full_test_frame.index.name = 'Data_Point'
+    full_test_frame = full_test_frame.round({'Step_Time': 4})
+    full_test_frame['Step_Index'] = full_test_frame.Step_Index.astype('int')
+    full_test_frame['Cycle_Index'] = full_test_frame.Cycle_Index.astype('int')
+
+    monkeypatch.setattr(data_join, 'iter_db_frames',
+                        lambda *args: iter(db_frames))
+    joined_frames = data_join.JoinedFrames(None, 1, 1, [0], [400], ['db,'])
+    csv_chunks = [
+        chunk.to_csv(header=index == 0)
+        for index, chunk in enumerate(joined_frames)
+    ]
+    assert ''.join(csv_chunks) == full_test_frame.to_csv()
+    assert joined_frames.length == len(full_test_frame.index)
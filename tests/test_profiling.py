@@ -0,0 +1,56 @@
+# Copyright 2018 Toyota Research Institute. All rights reserved.
+import os
+import csv
+import profiling
+
+
+def convert(profiler: profiling.SweepProfiler, name: str,
+            n_rows: int) -> None:
+    with profiler.channel(name):
+        with profiler.stage('join'):
+            rows = [list(range(100)) for _ in range(n_rows)]
+        with profiler.stage('write'):
+            del rows
+
+
+def test_summary_ranks_channels(tmpdir):
+    profiler = profiling.SweepProfiler(str(tmpdir), interval=0.001)
+    convert(profiler, 'small_CH1', 10)
+    convert(profiler, 'large_CH2', 5000)
+    profiler.summarize()
+    with open(os.path.join(profiler.folder, 'summary.csv')) as f:
+        summary = list(csv.DictReader(f))
+    assert [row['channel'] for row in summary] == ['large_CH2', 'small_CH1']
+    assert int(summary[0]['peak_bytes']) > int(summary[1]['peak_bytes'])
+    for suffix in ['_stages.csv', '_memory.txt', '_cpu.txt']:
+        assert os.path.exists(
+            os.path.join(profiler.folder, 'large_CH2' + suffix))
+    with open(os.path.join(profiler.folder, 'large_CH2_stages.csv')) as f:
+        assert [row['stage'] for row in csv.DictReader(f)] == \
+            ['join', 'write']
+
+
+def test_peak_between_stages_is_kept(tmpdir):
+    profiler = profiling.SweepProfiler(str(tmpdir), interval=0.001)
+    with profiler.channel('test_CH1'):
+        with profiler.stage('join'):
+            pass
+        # written while the join is paused between stages
+        block = bytearray(20 * 1024 * 1024)
+        del block
+        with profiler.stage('join'):
+            pass
+    assert profiler.channels[0]['peak'] > 20 * 1024 * 1024
+
+
+def test_sweeps_in_the_same_second(tmpdir):
+    first = profiling.SweepProfiler(str(tmpdir))
+    second = profiling.SweepProfiler(str(tmpdir))
+    assert first.folder != second.folder
+
+
+def test_null_profiler():
+    with profiling.NULL_PROFILER.channel('test_CH1'):
+        with profiling.NULL_PROFILER.stage('join'):
+            pass
+    profiling.NULL_PROFILER.summarize()